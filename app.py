@@ -1,147 +1,333 @@
 import streamlit as st
 import pandas as pd
-from docx import Document
-from docx.shared import Inches
-from datetime import datetime
+import hashlib
 import io
+import multiprocessing
+import os
+import shutil
+import tempfile
 import zipfile
-from typing import Dict, List, Tuple
+from operator import itemgetter
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+from xml.sax.saxutils import escape
 import re
 
-def parse_date(date_str: str) -> datetime:
-    """Parse date string in format 'MMM DD, YYYY' to datetime object"""
-    try:
-        return datetime.strptime(date_str, "%b %d, %Y")
-    except ValueError:
-        # Fallback for different date formats
-        try:
-            return datetime.strptime(date_str, "%B %d, %Y")
-        except ValueError:
-            # If all else fails, return a default date
-            return datetime.min
+# Characters that are not allowed in filenames on common platforms
+_FNAME_BAD = re.compile(r'[<>:"/\\|?*]')
 
-def replace_mp_name_in_letter(letter_content: str, salutation: str, last_name: str) -> str:
-    """Replace [MP Name] placeholder with salutation and last name"""
-    mp_greeting = f"{salutation} {last_name}"
-    return letter_content.replace("[MP Name]", mp_greeting)
+# Separators between multiple electorates in the ELECTORATE column
+_ELECT_SEP = re.compile(r'[,\n]')
 
-def create_docx_for_electorate(electorate: str, mp_info: Dict, letters: List[Dict]) -> io.BytesIO:
-    """Create a DOCX document for a specific electorate with all letters"""
-    doc = Document()
-    
-    # Set default font to Roboto for the entire document
-    style = doc.styles['Normal']
-    style.font.name = 'Roboto'
+# Rows of the letters CSV read at a time
+LETTERS_CHUNKSIZE = 100_000
+
+# Below this many letters across all documents, generating serially beats
+# starting worker processes (a few seconds of startup vs ~10µs per letter)
+PARALLEL_MIN_LETTERS = 250_000
+
+# Upper bound on worker processes used for document generation
+MAX_DOCX_WORKERS = 4
+
+# Batch ZIPs larger than this are spilled to a temporary file on disk
+ZIP_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Characters that are not allowed in XML 1.0 text (C0 controls, lone surrogates, U+FFFE/U+FFFF)
+_XML_BAD = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+# Line breaks and tabs inside letter text, written as <w:br/> and <w:tab/>
+_TEXT_BREAKS = re.compile(r'([\n\r\t])')
+
+# Static parts of the DOCX package. Documents only use the Normal style (Roboto),
+# with the page size, margins and spacing of python-docx's default template.
+_W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+
+_CONTENT_TYPES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '<Override PartName="/word/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    '</Types>'
+)
+
+_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+_DOCUMENT_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+_STYLES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<w:styles xmlns:w="{_W_NS}">'
+    '<w:docDefaults>'
+    '<w:rPrDefault><w:rPr>'
+    '<w:sz w:val="22"/><w:szCs w:val="22"/>'
+    '<w:lang w:val="en-US" w:eastAsia="en-US" w:bidi="ar-SA"/>'
+    '</w:rPr></w:rPrDefault>'
+    '<w:pPrDefault><w:pPr><w:spacing w:after="200" w:line="276" w:lineRule="auto"/></w:pPr></w:pPrDefault>'
+    '</w:docDefaults>'
+    '<w:style w:type="paragraph" w:default="1" w:styleId="Normal">'
+    '<w:name w:val="Normal"/><w:qFormat/>'
+    '<w:rPr><w:rFonts w:ascii="Roboto" w:hAnsi="Roboto"/></w:rPr>'
+    '</w:style>'
+    '</w:styles>'
+)
+
+_DOCUMENT_XML_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    f'<w:document xmlns:w="{_W_NS}"><w:body>'
+)
+
+_DOCUMENT_XML_TAIL = (
+    '<w:sectPr>'
+    '<w:pgSz w:w="12240" w:h="15840"/>'
+    '<w:pgMar w:top="1440" w:right="1800" w:bottom="1440" w:left="1800" '
+    'w:header="720" w:footer="720" w:gutter="0"/>'
+    '<w:cols w:space="720"/>'
+    '<w:docGrid w:linePitch="360"/>'
+    '</w:sectPr>'
+    '</w:body></w:document>'
+)
+
+# Prebuilt layout of one letter: bold date, empty line, letter content,
+# empty line, bold postcode and state. Letters are separated by page breaks.
+_LETTER_XML = (
+    '<w:p><w:r><w:rPr><w:b/></w:rPr>{date}</w:r></w:p>'
+    '<w:p/>'
+    '<w:p><w:r>{content}</w:r></w:p>'
+    '<w:p/>'
+    '<w:p><w:r><w:rPr><w:b/></w:rPr>{location}</w:r></w:p>'
+)
+_PAGE_BREAK_XML = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+def build_docx_template() -> bytes:
+    """Package the static DOCX parts once; each document only appends its body"""
+    template_buffer = io.BytesIO()
+    with zipfile.ZipFile(template_buffer, 'w', zipfile.ZIP_DEFLATED) as docx_zip:
+        docx_zip.writestr('[Content_Types].xml', _CONTENT_TYPES_XML)
+        docx_zip.writestr('_rels/.rels', _RELS_XML)
+        docx_zip.writestr('word/_rels/document.xml.rels', _DOCUMENT_RELS_XML)
+        docx_zip.writestr('word/styles.xml', _STYLES_XML)
+    return template_buffer.getvalue()
+
+_DOCX_TEMPLATE = build_docx_template()
+
+def parse_dates(date_strs: pd.Series) -> pd.Series:
+    """Parse a column of date strings in format 'MMM DD, YYYY' to timestamps"""
+    dates = pd.to_datetime(date_strs, format="%b %d, %Y", errors="coerce")
+    # Fallback for different date formats
+    dates = dates.fillna(pd.to_datetime(date_strs, format="%B %d, %Y", errors="coerce"))
+    # If all else fails, use a default date so unparseable letters sort first
+    return dates.fillna(pd.Timestamp.min)
+
+def text_to_run_xml(text: str) -> str:
+    """Convert text to the contents of a WordprocessingML run, escaping it for XML"""
+    parts = []
+    for piece in _TEXT_BREAKS.split(_XML_BAD.sub('', text)):
+        if piece == '\t':
+            parts.append('<w:tab/>')
+        elif piece in ('\n', '\r'):
+            parts.append('<w:br/>')
+        elif piece:
+            parts.append(f'<w:t xml:space="preserve">{escape(piece)}</w:t>')
+    return ''.join(parts)
+
+# Campaign letters often share the same text, so each distinct body is only escaped once per process
+@lru_cache(maxsize=1024)
+def letter_body_xml(letter_text: str) -> Tuple[str, ...]:
+    """Convert letter text to run XML, split around each [MP Name] placeholder"""
+    return tuple(text_to_run_xml(piece) for piece in letter_text.split("[MP Name]"))
+
+def create_docx_for_electorate(electorate: str, mp_info: Dict, letters: List[Tuple]) -> bytes:
+    """Create a DOCX document for a specific electorate with all letters, returned as bytes"""
+    body = []
+    greeting_xml = text_to_run_xml(mp_info['Greeting'])
     
     # Sort letters by date (ascending)
-    sorted_letters = sorted(letters, key=lambda x: parse_date(x['Submission Date']))
+    # Each letter is a (submission date, letter text, postcode, state, parsed date) tuple
+    sorted_letters = sorted(letters, key=itemgetter(4))
     
-    for i, letter in enumerate(sorted_letters):
-        # Add date
-        date_paragraph = doc.add_paragraph()
-        date_paragraph.add_run(f"Date: {letter['Submission Date']}").bold = True
-        
-        # Add empty line
-        doc.add_paragraph()
-        
-        # Process letter content - replace MP name
-        letter_content = replace_mp_name_in_letter(
-            letter['Your letter'], 
-            mp_info['Salutation'], 
-            mp_info['Last name']
-        )
-        
-        # Add letter content
-        doc.add_paragraph(letter_content)
-        
-        # Add empty line
-        doc.add_paragraph()
-        
-        # Add postcode and state
-        location_paragraph = doc.add_paragraph()
-        location_paragraph.add_run(f"{letter['POSTCODE']}, {letter['STATE']}").bold = True
-        
-        # Add page break if not the last letter
-        if i < len(sorted_letters) - 1:
-            doc.add_page_break()
+    for submission_date, letter_text, postcode, state, _ in sorted_letters:
+        body.append(_LETTER_XML.format(
+            date=text_to_run_xml(f"Date: {submission_date}"),
+            # Letter content, with the MP name filled in
+            content=greeting_xml.join(letter_body_xml(letter_text)),
+            location=text_to_run_xml(f"{postcode}, {state}")
+        ))
     
-    # Save to BytesIO
-    doc_buffer = io.BytesIO()
-    doc.save(doc_buffer)
-    doc_buffer.seek(0)
+    # Page breaks go between letters, not after the last one
+    document_xml = _DOCUMENT_XML_HEAD + _PAGE_BREAK_XML.join(body) + _DOCUMENT_XML_TAIL
     
-    return doc_buffer
+    # Start from the prebuilt package (styles etc.) and add this document's body
+    doc_buffer = io.BytesIO(_DOCX_TEMPLATE)
+    with zipfile.ZipFile(doc_buffer, 'a', zipfile.ZIP_DEFLATED) as docx_zip:
+        docx_zip.writestr('word/document.xml', document_xml)
+    
+    return doc_buffer.getvalue()
+
+def create_docx_for_mps(electorate: str, mp_infos: List[Dict], letters: List[Tuple]) -> List[bytes]:
+    """Create a DOCX document for each MP of one electorate, which all receive the same letters"""
+    return [create_docx_for_electorate(electorate, mp_info, letters) for mp_info in mp_infos]
 
-def process_files(mps_df: pd.DataFrame, letters_df: pd.DataFrame) -> Dict[str, io.BytesIO]:
-    """Process the uploaded files and generate DOCX files for each electorate"""
+def load_csv(csv_file, columns: List[str], use_pyarrow: bool = False, chunksize: Optional[int] = None, nrows: Optional[int] = None):
+    """Load only the given columns from an uploaded CSV file, optionally as an iterator of chunks"""
+    # Read just the header so missing columns are left for the caller to report
+    csv_file.seek(0)
+    header = pd.read_csv(csv_file, nrows=0).columns
+    usecols = [col for col in columns if col in header]
+    csv_file.seek(0)
+    
+    if chunksize is not None:
+        # Read everything as text so values format the same whichever chunk they land in
+        # (otherwise a blank POSTCODE turns only its own chunk's postcodes into floats)
+        return pd.read_csv(csv_file, usecols=usecols, chunksize=chunksize, dtype={col: str for col in usecols})
+    
+    if use_pyarrow:
+        try:
+            return pd.read_csv(csv_file, engine='pyarrow', usecols=usecols)
+        except (ImportError, ValueError):
+            # PyArrow is optional, and its parser rejects some files the default one accepts
+            csv_file.seek(0)
+    
+    return pd.read_csv(csv_file, usecols=usecols, nrows=nrows)
+
+def process_files(mps_df: pd.DataFrame, letter_chunks: Iterable[pd.DataFrame]) -> Tuple[Dict[str, io.BytesIO], Dict[str, Dict], Dict[str, int], int]:
+    """Process the uploaded files and generate DOCX files for each electorate, along with the MP lookup, letter counts and total letters read"""
     results = {}
     
     # Create a dictionary for MP lookup - handle multiple MPs per electorate
     mp_dict = {}
-    for _, mp in mps_df.iterrows():
-        electorate = mp['State/Electorate']
-        full_name = f"{mp['First name']} {mp['Last name']}"
+    for salutation, first_name, last_name, electorate in zip(
+        mps_df['Salutation'].to_numpy(),
+        mps_df['First name'].to_numpy(),
+        mps_df['Last name'].to_numpy(),
+        mps_df['State/Electorate'].to_numpy(),
+    ):
+        full_name = f"{first_name} {last_name}"
         mp_key = f"{electorate}_{full_name}"  # Unique key for each MP
         mp_dict[mp_key] = {
             'Electorate': electorate,
-            'Salutation': mp['Salutation'],
-            'First name': mp['First name'],
-            'Last name': mp['Last name'],
-            'Fullname': full_name  # Keep for filename compatibility
+            'Salutation': salutation,
+            'First name': first_name,
+            'Last name': last_name,
+            'Fullname': full_name,  # Keep for filename compatibility
+            'Greeting': f"{salutation} {last_name}"  # Replaces [MP Name] in letters
         }
     
-    # Group letters by electorate and state (only for those that have MPs)
+    # Index MPs by electorate/state so each letter can find its MPs directly
+    elect_index = defaultdict(list)
+    for mp_key, mp_info in mp_dict.items():
+        elect_index[mp_info['Electorate']].append(mp_key)
+    
+    # Letters arrive in chunks so large files are never fully loaded as a DataFrame;
+    # only the grouped letter tuples are kept for document generation
     electorate_letters = {}
-    for _, letter in letters_df.iterrows():
-        # Check ELECTORATE column
-        electorate_raw = str(letter['ELECTORATE'])
+    letter_counts = {}
+    letters_total = 0
+    for letters_df in letter_chunks:
+        letters_total += len(letters_df)
         
-        # Handle comma-separated and newline-separated electorates 
-        # (e.g., "Bruce, Hotham" or "Blaxland\nMcMahon")
-        # First split by newlines, then by commas
-        temp_electorates = []
-        for part in electorate_raw.split('\n'):
-            temp_electorates.extend([e.strip() for e in part.split(',')])
+        # Build each letter once; the same tuple is shared by every MP it is sent to
+        letter_tuples = pd.Series(
+            list(zip(
+                letters_df['Submission Date'].tolist(),
+                letters_df['Your letter'].tolist(),
+                letters_df['POSTCODE'].tolist(),
+                letters_df['STATE'].tolist(),
+                parse_dates(letters_df['Submission Date']).tolist()
+            )),
+            index=letters_df.index,
+            dtype=object
+        )
         
-        electorates = [e.strip() for e in temp_electorates if e.strip()]
+        # Split multi-electorate cells into one row per electorate
+        # (e.g., "Bruce, Hotham" or "Blaxland\nMcMahon")
+        by_electorate = pd.DataFrame({
+            '_letter': letter_tuples,
+            '_electorate': letters_df['ELECTORATE'].astype(str).str.split(_ELECT_SEP)
+        }).explode('_electorate')
+        by_electorate['_electorate'] = by_electorate['_electorate'].str.strip()
         
         # Also check STATE column
-        state = str(letter['STATE']).strip()
-        if state:
-            electorates.append(state)
+        by_state = pd.DataFrame({
+            '_letter': letter_tuples,
+            '_electorate': letters_df['STATE'].astype(str).str.strip()
+        })
         
-        for electorate in electorates:
-            # Find all MPs for this electorate/state
-            matching_mps = [key for key in mp_dict.keys() if mp_dict[key]['Electorate'] == electorate]
-            
-            # Add letter to each MP's document for this electorate
-            for mp_key in matching_mps:
-                if mp_key not in electorate_letters:
-                    electorate_letters[mp_key] = []
-                
-                electorate_letters[mp_key].append({
-                    'Submission Date': letter['Submission Date'],
-                    'Your letter': letter['Your letter'],
-                    'POSTCODE': letter['POSTCODE'],
-                    'STATE': letter['STATE']
-                })
+        combined = pd.concat([by_electorate, by_state])
+        combined = combined[combined['_electorate'].str.len() > 0]
+        
+        # Letters per electorate/state, for the summary
+        for electorate, count in combined['_electorate'].value_counts().items():
+            letter_counts[electorate] = letter_counts.get(electorate, 0) + int(count)
+        
+        # Group letters by electorate and state (only for those that have MPs).
+        # Every MP of an electorate gets the same letters, so they share one list.
+        for electorate, group in combined.groupby('_electorate', sort=False):
+            if electorate in elect_index:
+                electorate_letters.setdefault(electorate, []).extend(group['_letter'].tolist())
     
-    # Generate DOCX for each MP that has letters
+    # Generate DOCX for each MP that has letters. Each electorate is one task, so
+    # letters shared by several MPs (e.g. a state's senators) are sent to a worker once.
+    documents = {}
+    letters_to_write = sum(
+        len(letters) * len(elect_index[electorate]) for electorate, letters in electorate_letters.items()
+    )
+    workers = min(MAX_DOCX_WORKERS, os.cpu_count() or 1)
+    
+    if letters_to_write < PARALLEL_MIN_LETTERS or workers < 2:
+        for electorate, letters in electorate_letters.items():
+            mp_keys = elect_index[electorate]
+            mp_infos = [mp_dict[mp_key] for mp_key in mp_keys]
+            documents.update(zip(mp_keys, create_docx_for_mps(electorate, mp_infos, letters)))
+    else:
+        # Spawn rather than fork: forking the multi-threaded Streamlit server can deadlock
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {
+                electorate: executor.submit(
+                    create_docx_for_mps,
+                    electorate,
+                    [mp_dict[mp_key] for mp_key in elect_index[electorate]],
+                    letters
+                )
+                for electorate, letters in electorate_letters.items()
+            }
+            for electorate, future in futures.items():
+                documents.update(zip(elect_index[electorate], future.result()))
+    
+    # Collect in MP order so downloads and the summary keep a stable ordering
     for mp_key in mp_dict.keys():
-        if mp_key in electorate_letters:
-            letters = electorate_letters[mp_key]
-            mp_info = mp_dict[mp_key]
-            
-            doc_buffer = create_docx_for_electorate(mp_info['Electorate'], mp_info, letters)
-            results[mp_key] = doc_buffer
+        if mp_key in documents:
+            results[mp_key] = io.BytesIO(documents[mp_key])
     
-    return results
+    return results, mp_dict, letter_counts, letters_total
 
-def create_zip_file(docx_files: Dict[str, io.BytesIO], mp_dict: Dict) -> io.BytesIO:
+def create_zip_file(docx_files: Dict[str, io.BytesIO], mp_dict: Dict, compress: bool = False) -> tempfile.SpooledTemporaryFile:
     """Create a ZIP file containing all DOCX files"""
-    zip_buffer = io.BytesIO()
+    zip_buffer = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE, suffix='.zip')
     
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+    # DOCX files are already deflated internally, so store them as-is unless asked otherwise
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    
+    with zipfile.ZipFile(zip_buffer, 'w', compression) as zip_file:
         for mp_key, doc_buffer in docx_files.items():
             # Get MP info for filename
             mp_info = mp_dict.get(mp_key, {})
@@ -149,10 +335,14 @@ def create_zip_file(docx_files: Dict[str, io.BytesIO], mp_dict: Dict) -> io.Byte
             fullname = mp_info.get('Fullname', 'Unknown')
             
             # Create filename: "Electorate, Fullname.docx"
-            clean_electorate = re.sub(r'[<>:"/\\|?*]', '', electorate)
-            clean_fullname = re.sub(r'[<>:"/\\|?*]', '', fullname)
+            clean_electorate = _FNAME_BAD.sub('', electorate)
+            clean_fullname = _FNAME_BAD.sub('', fullname)
             filename = f"{clean_electorate}, {clean_fullname}.docx"
-            zip_file.writestr(filename, doc_buffer.getvalue())
+            
+            # Stream the document into the archive rather than copying it with getvalue()
+            doc_buffer.seek(0)
+            with zip_file.open(filename, 'w') as dest:
+                shutil.copyfileobj(doc_buffer, dest, length=1024 * 1024)
     
     zip_buffer.seek(0)
     return zip_buffer
@@ -186,24 +376,42 @@ def main():
     
     if mps_file is not None and letters_file is not None:
         try:
-            # Load the CSV files
-            mps_df = pd.read_csv(mps_file)
-            letters_df = pd.read_csv(letters_file)
-            
-            # Validate required columns
             required_mp_columns = ['Salutation', 'First name', 'Last name', 'State/Electorate']
             required_letter_columns = ['ELECTORATE', 'Submission Date', 'Your letter', 'POSTCODE', 'STATE']
             
-            missing_mp_cols = [col for col in required_mp_columns if col not in mps_df.columns]
-            missing_letter_cols = [col for col in required_letter_columns if col not in letters_df.columns]
+            # Fingerprint the uploads so reruns (e.g. download clicks) can reuse loaded and generated data
+            input_hash = (
+                hashlib.md5(mps_file.getvalue(), usedforsecurity=False).hexdigest(),
+                hashlib.md5(letters_file.getvalue(), usedforsecurity=False).hexdigest()
+            )
             
-            if missing_mp_cols:
-                st.error(f"MPs CSV is missing required columns: {', '.join(missing_mp_cols)}")
-                return
+            if st.session_state.get('loaded_hash') != input_hash:
+                # Load the CSV files (only the columns we use). Letters often contain
+                # line breaks inside quoted cells, which PyArrow's parallel reader
+                # cannot split reliably, so they stay on the default parser.
+                mps_df = load_csv(mps_file, required_mp_columns, use_pyarrow=True)
+                
+                # Letters are only read in full (in chunks) when generating; here we just preview them
+                letters_preview = load_csv(letters_file, required_letter_columns, nrows=3)
+                
+                # Validate required columns
+                missing_mp_cols = [col for col in required_mp_columns if col not in mps_df.columns]
+                missing_letter_cols = [col for col in required_letter_columns if col not in letters_preview.columns]
+                
+                if missing_mp_cols:
+                    st.error(f"MPs CSV is missing required columns: {', '.join(missing_mp_cols)}")
+                    return
+                
+                if missing_letter_cols:
+                    st.error(f"Letters CSV is missing required columns: {', '.join(missing_letter_cols)}")
+                    return
+                
+                st.session_state['mps_df'] = mps_df
+                st.session_state['letters_preview'] = letters_preview
+                st.session_state['loaded_hash'] = input_hash
             
-            if missing_letter_cols:
-                st.error(f"Letters CSV is missing required columns: {', '.join(missing_letter_cols)}")
-                return
+            mps_df = st.session_state['mps_df']
+            letters_preview = st.session_state['letters_preview']
             
             # Display file information
             st.success("Files uploaded successfully!")
@@ -215,64 +423,45 @@ def main():
                 st.dataframe(mps_df.head(3))
             
             with col2:
-                st.info(f"**Letters loaded:** {len(letters_df)} records")
+                st.info(f"**Letters file:** {letters_file.name} (record count is shown after generation)")
                 st.write("Sample Letter data:")
-                st.dataframe(letters_df[['ELECTORATE', 'Submission Date', 'POSTCODE', 'STATE']].head(3))
+                st.dataframe(letters_preview[['ELECTORATE', 'Submission Date', 'POSTCODE', 'STATE']])
             
             # Process files and generate documents
-            if st.button("Generate DOCX Files", type="primary"):
+            if st.button("Generate DOCX Files", type="primary") or st.session_state.get('input_hash') == input_hash:
                 with st.spinner("Processing files and generating documents..."):
                     try:
-                        docx_files = process_files(mps_df, letters_df)
-                        
-                        if not docx_files:
-                            st.warning("No matching electorates found between MPs and Letters files.")
-                            return
-                        
-                        # Create MP dict for filename generation (same structure as process_files)
-                        mp_dict = {}
-                        for _, mp in mps_df.iterrows():
-                            electorate = mp['State/Electorate']
-                            full_name = f"{mp['First name']} {mp['Last name']}"
-                            mp_key = f"{electorate}_{full_name}"
-                            mp_dict[mp_key] = {
-                                'Electorate': electorate,
-                                'Salutation': mp['Salutation'],
-                                'First name': mp['First name'],
-                                'Last name': mp['Last name'],
-                                'Fullname': full_name
-                            }
+                        if st.session_state.get('input_hash') == input_hash:
+                            docx_files = st.session_state['docx_files']
+                            mp_dict = st.session_state['mp_dict']
+                            letter_counts = st.session_state['letter_counts']
+                            letters_total = st.session_state['letters_total']
+                        else:
+                            docx_files, mp_dict, letter_counts, letters_total = process_files(
+                                mps_df,
+                                load_csv(letters_file, required_letter_columns, chunksize=LETTERS_CHUNKSIZE)
+                            )
+                            
+                            if not docx_files:
+                                st.warning("No matching electorates found between MPs and Letters files.")
+                                return
+                            
+                            st.session_state['docx_files'] = docx_files
+                            st.session_state['mp_dict'] = mp_dict
+                            st.session_state['letter_counts'] = letter_counts
+                            st.session_state['letters_total'] = letters_total
+                            
+                            # st.download_button needs bytes, so read the ZIP once here rather than on every rerun
+                            with create_zip_file(docx_files, mp_dict) as zip_buffer:
+                                st.session_state['zip_bytes'] = zip_buffer.read()
+                            st.session_state['input_hash'] = input_hash
                         
-                        st.success(f"Generated {len(docx_files)} DOCX files!")
+                        st.success(f"Generated {len(docx_files)} DOCX files from {letters_total} letters!")
                         
                         # Show summary
                         st.header("Generation Summary")
                         summary_data = []
                         
-                        # Count letters by electorate and state (matching the processing logic)
-                        letter_counts = {}
-                        for _, letter in letters_df.iterrows():
-                            # Check ELECTORATE column
-                            electorate_raw = str(letter['ELECTORATE'])
-                            
-                            # Handle comma-separated and newline-separated electorates 
-                            temp_electorates = []
-                            for part in electorate_raw.split('\n'):
-                                temp_electorates.extend([e.strip() for e in part.split(',')])
-                            
-                            electorates = [e.strip() for e in temp_electorates if e.strip()]
-                            
-                            # Also check STATE column
-                            state = str(letter['STATE']).strip()
-                            if state:
-                                electorates.append(state)
-                            
-                            for electorate in electorates:
-                                if electorate in letter_counts:
-                                    letter_counts[electorate] += 1
-                                else:
-                                    letter_counts[electorate] = 1
-                        
                         for mp_key in docx_files.keys():
                             mp_info = mp_dict.get(mp_key, {})
                             electorate = mp_info.get('Electorate', 'Unknown')
@@ -299,8 +488,8 @@ def main():
                                 fullname = mp_info.get('Fullname', 'Unknown')
                                 
                                 # Create filename: "Electorate, Fullname.docx"
-                                clean_electorate = re.sub(r'[<>:"/\\|?*]', '', electorate)
-                                clean_fullname = re.sub(r'[<>:"/\\|?*]', '', fullname)
+                                clean_electorate = _FNAME_BAD.sub('', electorate)
+                                clean_fullname = _FNAME_BAD.sub('', fullname)
                                 filename = f"{clean_electorate}, {clean_fullname}.docx"
                                 
                                 st.download_button(
@@ -312,11 +501,9 @@ def main():
                         
                         # Batch download as ZIP
                         st.subheader("Batch Download")
-                        zip_buffer = create_zip_file(docx_files, mp_dict)
-                        
                         st.download_button(
                             label="📦 Download All Files as ZIP",
-                            data=zip_buffer.getvalue(),
+                            data=st.session_state['zip_bytes'],
                             file_name="all_electorate_letters.zip",
                             mime="application/zip"
                         )